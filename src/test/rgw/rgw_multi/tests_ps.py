@@ -716,21 +716,11 @@ def test_ps_event_fetching():
     # wait for sync
     zone_bucket_checkpoint(ps_zones[0].zone, zones[0].zone, bucket_name)
     max_events = 15
-    total_events_count = 0
-    next_marker = None
-    all_events = []
-    while True:
-        # get the events from the subscription
-        result, _ = sub_conf.get_events(max_events, next_marker)
-        parsed_result = json.loads(result)
-        events = parsed_result['events']
-        total_events_count += len(events)
-        all_events.extend(events)
-        next_marker = parsed_result['next_marker']
-        for event in events:
-            log.debug('Event: objname: "' + str(event['info']['key']['name']) + '" type: "' + str(event['event']) + '"')
-        if next_marker == '':
-            break
+    # get the events from the subscription
+    all_events, status = sub_conf.drain_events(page_size=max_events)
+    assert_equal(status/100, 2)
+    for event in all_events:
+        log.debug('Event: objname: "' + str(event['info']['key']['name']) + '" type: "' + str(event['event']) + '"')
     keys = list(bucket.list())
     # TODO: set exact_match to true
     verify_events_by_elements(all_events, keys, exact_match=False)
@@ -1,14 +1,17 @@
 import logging
+import json
 import httplib
 import urllib
 import hmac
 import hashlib
 import base64
+import socket
+import threading
+from collections import OrderedDict
+from multiprocessing.pool import ThreadPool
 import xmltodict
-from time import gmtime, strftime
+from time import gmtime, strftime, time
 from .multisite import Zone
-import boto3
-from botocore.client import Config
 
 log = logging.getLogger('rgw_multi.tests')
 
@@ -33,6 +36,26 @@ class PSZone(Zone):  # pylint: disable=too-many-ancestors
 
 NO_HTTP_BODY = ''
 
+# idle keep-alive connections to the radosgw endpoints, keyed by (host, port)
+HTTP_CONN_POOL_MAXSIZE = 16
+_HTTP_CONN_POOL = {}
+_HTTP_CONN_POOL_LOCK = threading.Lock()
+# dump http traffic when debug logging is enabled (see: set_debug())
+_DEBUG_HTTP = log.getEffectiveLevel() <= 10
+
+# RFC 1123 date of the last second a request was sent at: [seconds since epoch, date string]
+_LAST_DATE = [0, '']
+_LAST_DATE_LOCK = threading.Lock()
+
+# keyed HMAC-SHA1 objects (before any message was fed), keyed by secret
+HMAC_CACHE_MAXSIZE = 16
+_HMAC_TEMPLATES = OrderedDict()
+_HMAC_TEMPLATES_LOCK = threading.Lock()
+
+# boto3 S3 clients, shared by all PSNotificationS3 objects of the same endpoint and user
+_S3_CLIENT_CACHE = {}
+_S3_CLIENT_CACHE_LOCK = threading.Lock()
+
 
 def print_connection_info(conn):
     """print connection details"""
@@ -41,39 +64,154 @@ def print_connection_info(conn):
     print('AWS Secret Key:: ' + conn.aws_secret_access_key)
 
 
-def make_request(conn, method, resource, parameters=None, sign_parameters=False, extra_parameters=None):
-    """generic request sending to pubsub radogw
-    should cover: topics, notificatios and subscriptions
-    """
+def set_debug(flag):
+    """enable/disable dumping of the http traffic"""
+    global _DEBUG_HTTP
+    with _HTTP_CONN_POOL_LOCK:
+        _DEBUG_HTTP = flag
+        for idle_conns in _HTTP_CONN_POOL.values():
+            for http_conn in idle_conns:
+                http_conn.set_debuglevel(5 if flag else 0)
+
+
+def _new_http_conn(host, port):
+    """create a new connection to the endpoint"""
+    http_conn = httplib.HTTPConnection(host, port)
+    if _DEBUG_HTTP:
+        http_conn.set_debuglevel(5)
+    return http_conn
+
+
+def _get_http_conn(host, port):
+    """get an idle pooled connection to the endpoint, or create a new one"""
+    with _HTTP_CONN_POOL_LOCK:
+        idle_conns = _HTTP_CONN_POOL.get((host, port))
+        if idle_conns:
+            return idle_conns.pop()
+    return _new_http_conn(host, port)
+
+
+def _put_http_conn(host, port, http_conn):
+    """return a connection to the pool so that it could be reused"""
+    with _HTTP_CONN_POOL_LOCK:
+        idle_conns = _HTTP_CONN_POOL.setdefault((host, port), [])
+        if len(idle_conns) < HTTP_CONN_POOL_MAXSIZE:
+            idle_conns.append(http_conn)
+            return
+    http_conn.close()
+
+
+def _get_date():
+    """get the current date, formatted once per second"""
+    now = int(time())
+    with _LAST_DATE_LOCK:
+        if now != _LAST_DATE[0]:
+            _LAST_DATE[0] = now
+            _LAST_DATE[1] = strftime("%a, %d %b %Y %H:%M:%S +0000", gmtime(now))
+        return _LAST_DATE[1]
+
+
+def _sign(secret, string_to_sign):
+    """HMAC-SHA1 sign a string, reusing the keyed hash state of the secret"""
+    with _HMAC_TEMPLATES_LOCK:
+        template = _HMAC_TEMPLATES.get(secret)
+        if template is None:
+            template = hmac.new(secret, None, hashlib.sha1)
+            _HMAC_TEMPLATES[secret] = template
+            if len(_HMAC_TEMPLATES) > HMAC_CACHE_MAXSIZE:
+                _HMAC_TEMPLATES.popitem(last=False)
+    mac = template.copy()
+    mac.update(string_to_sign)
+    return base64.b64encode(mac.digest())
+
+
+def _get_header_prefixes(conn):
+    """get the constant parts of the request headers of a connection: authorization prefix and host"""
+    prefixes = getattr(conn, '_ps_header_prefixes', None)
+    if prefixes is None:
+        prefixes = ('AWS ' + conn.aws_access_key_id + ':', conn.host + ':' + str(conn.port))
+        conn._ps_header_prefixes = prefixes
+    return prefixes
+
+
+def build_url_params(parameters=None, extra_parameters=None):
+    """build the query string part of a request url"""
     url_params = ''
     if parameters is not None:
-        url_params = urllib.urlencode(parameters)
-        # remove 'None' from keys with no values
-        url_params = url_params.replace('=None', '')
-        url_params = '?' + url_params
+        # keys with 'None' values are sent without a value
+        pairs = [(k, v) for k, v in parameters.iteritems() if v is not None]
+        valueless = [k for k, v in parameters.iteritems() if v is None]
+        query = [urllib.urlencode(pairs)] if pairs else []
+        url_params = '?' + '&'.join(query + valueless)
     if extra_parameters is not None:
         url_params = url_params + '&' + extra_parameters
-    string_date = strftime("%a, %d %b %Y %H:%M:%S +0000", gmtime())
-    string_to_sign = method + '\n\n\n' + string_date + '\n' + resource
-    if sign_parameters:
-        string_to_sign += url_params
-    signature = base64.b64encode(hmac.new(conn.aws_secret_access_key,
-                                          string_to_sign.encode('utf-8'),
-                                          hashlib.sha1).digest())
-    headers = {'Authorization': 'AWS '+conn.aws_access_key_id+':'+signature,
+    return url_params
+
+
+def make_request(conn, method, resource, parameters=None, sign_parameters=False, extra_parameters=None,
+                 precomputed_url_params=None, response_parser=None):
+    """generic request sending to pubsub radogw
+    should cover: topics, notificatios and subscriptions
+    precomputed_url_params (output of build_url_params) takes precedence over parameters/extra_parameters
+    response_parser, if set, is called with the (file like) http response, and its result is returned
+    instead of the response body, so that the body could be parsed while it is received
+    """
+    if precomputed_url_params is not None:
+        url_params = precomputed_url_params
+    else:
+        url_params = build_url_params(parameters, extra_parameters)
+    string_date = _get_date()
+    # all parts are ascii byte strings, so no encoding is needed before signing
+    string_to_sign = b''.join((method, b'\n\n\n', string_date, b'\n', resource,
+                               url_params if sign_parameters else b''))
+    signature = _sign(conn.aws_secret_access_key, string_to_sign)
+    auth_prefix, host_port = _get_header_prefixes(conn)
+    headers = {'Authorization': auth_prefix + signature,
                'Date': string_date,
-               'Host': conn.host+':'+str(conn.port)}
-    http_conn = httplib.HTTPConnection(conn.host, conn.port)
-    if log.getEffectiveLevel() <= 10:
-        http_conn.set_debuglevel(5)
-    http_conn.request(method, resource+url_params, NO_HTTP_BODY, headers)
-    response = http_conn.getresponse()
-    data = response.read()
+               'Host': host_port,
+               'Connection': 'keep-alive'}
+    http_conn = _get_http_conn(conn.host, conn.port)
+    try:
+        http_conn.request(method, resource+url_params, NO_HTTP_BODY, headers)
+        response = http_conn.getresponse()
+    except (httplib.BadStatusLine, httplib.CannotSendRequest, socket.error):
+        # pooled connection was closed by the server, retry once on a new one
+        http_conn.close()
+        http_conn = _new_http_conn(conn.host, conn.port)
+        http_conn.request(method, resource+url_params, NO_HTTP_BODY, headers)
+        response = http_conn.getresponse()
+    if response_parser is None:
+        data = response.read()
+    else:
+        data = response_parser(response)
     status = response.status
-    http_conn.close()
+    if response.isclosed():
+        _put_http_conn(conn.host, conn.port, http_conn)
+    else:
+        # body was not fully read, connection cannot be reused
+        http_conn.close()
     return data, status
 
 
+def parallel_apply(objects, method_name, max_workers=16):
+    """call a method (e.g. 'set_config') of multiple independent objects concurrently
+    the objects are not modified by their requests, so no locking is needed
+    returns a list of (object, data, status) in the order of the objects
+    """
+    def apply_one(obj):
+        data, status = getattr(obj, method_name)()
+        return obj, data, status
+
+    if not objects:
+        return []
+    pool = ThreadPool(min(max_workers, len(objects)))
+    try:
+        return pool.map(apply_one, objects)
+    finally:
+        pool.close()
+        pool.join()
+
+
 def print_connection_info(conn):
     """print info of connection"""
     print("Host: " + conn.host+':'+str(conn.port))
@@ -81,6 +219,12 @@ def print_connection_info(conn):
     print("AWS Access Key: " + conn.aws_access_key_id)
 
 
+def _require_nonblank(name, value):
+    """verify that a name is not empty or whitespace only"""
+    if not value or not value.strip():
+        raise ValueError(name + ' must be non-blank')
+
+
 class PSTopic:
     """class to set/get/delete a topic
     PUT /topics/<topic name>[?push-endpoint=<endpoint>&[<arg1>=<value1>...]]
@@ -89,7 +233,7 @@ class PSTopic:
     """
     def __init__(self, conn, topic_name, endpoint=None, endpoint_args=None):
         self.conn = conn
-        assert topic_name.strip()
+        _require_nonblank('topic_name', topic_name)
         self.resource = '/topics/'+topic_name
         if endpoint is not None:
             self.parameters = {'push-endpoint': endpoint}
@@ -97,13 +241,16 @@ class PSTopic:
         else:
             self.parameters = None
             self.extra_parameters = None
+        self.url_params = build_url_params(self.parameters, self.extra_parameters)
 
-    def send_request(self, method, get_list=False, parameters=None, extra_parameters=None):
+    def send_request(self, method, get_list=False, parameters=None, extra_parameters=None,
+                     precomputed_url_params=None):
         """send request to radosgw"""
         if get_list:
             return make_request(self.conn, method, '/topics')
         return make_request(self.conn, method, self.resource, 
-                            parameters=parameters, extra_parameters=extra_parameters)
+                            parameters=parameters, extra_parameters=extra_parameters,
+                            precomputed_url_params=precomputed_url_params)
 
     def get_config(self):
         """get topic info"""
@@ -111,7 +258,7 @@ class PSTopic:
 
     def set_config(self):
         """set topic"""
-        return self.send_request('PUT', parameters=self.parameters, extra_parameters=self.extra_parameters)
+        return self.send_request('PUT', precomputed_url_params=self.url_params)
 
     def del_config(self):
         """delete topic"""
@@ -130,17 +277,19 @@ class PSNotification:
     """
     def __init__(self, conn, bucket_name, topic_name, events=''):
         self.conn = conn
-        assert bucket_name.strip()
-        assert topic_name.strip()
+        _require_nonblank('bucket_name', bucket_name)
+        _require_nonblank('topic_name', topic_name)
         self.resource = '/notifications/bucket/'+bucket_name
         if events.strip():
             self.parameters = {'topic': topic_name, 'events': events}
         else:
             self.parameters = {'topic': topic_name}
+        self.url_params = build_url_params(self.parameters)
 
-    def send_request(self, method, parameters=None):
+    def send_request(self, method, parameters=None, precomputed_url_params=None):
         """send request to radosgw"""
-        return make_request(self.conn, method, self.resource, parameters)
+        return make_request(self.conn, method, self.resource, parameters,
+                            precomputed_url_params=precomputed_url_params)
 
     def get_config(self):
         """get notification info"""
@@ -148,11 +297,30 @@ class PSNotification:
 
     def set_config(self):
         """set notification"""
-        return self.send_request('PUT', self.parameters)
+        return self.send_request('PUT', precomputed_url_params=self.url_params)
 
     def del_config(self):
         """delete notification"""
-        return self.send_request('DELETE', self.parameters)
+        return self.send_request('DELETE', precomputed_url_params=self.url_params)
+
+
+def _get_s3_client(conn):
+    """get the shared boto3 S3 client of the connection's endpoint and user
+    boto3 is imported here, so that tests not using S3 notifications do not load it
+    """
+    key = (conn.host, conn.port, conn.aws_access_key_id, conn.aws_secret_access_key)
+    with _S3_CLIENT_CACHE_LOCK:
+        client = _S3_CLIENT_CACHE.get(key)
+        if client is None:
+            import boto3
+            from botocore.client import Config
+            client = boto3.client('s3',
+                                  endpoint_url='http://'+conn.host+':'+str(conn.port),
+                                  aws_access_key_id=conn.aws_access_key_id,
+                                  aws_secret_access_key=conn.aws_secret_access_key,
+                                  config=Config(signature_version='s3'))
+            _S3_CLIENT_CACHE[key] = client
+        return client
 
 
 class PSNotificationS3:
@@ -163,20 +331,17 @@ class PSNotificationS3:
     """
     def __init__(self, conn, bucket_name, topic_conf_list):
         self.conn = conn
-        assert bucket_name.strip()
+        _require_nonblank('bucket_name', bucket_name)
         self.bucket_name = bucket_name
         self.resource = '/'+bucket_name
         self.topic_conf_list = topic_conf_list
-        self.client = boto3.client('s3',
-                                   endpoint_url='http://'+conn.host+':'+str(conn.port),
-                                   aws_access_key_id=conn.aws_access_key_id,
-                                   aws_secret_access_key=conn.aws_secret_access_key,
-                                   config=Config(signature_version='s3'))
+        self.client = _get_s3_client(conn)
 
-    def send_request(self, method, parameters=None):
+    def send_request(self, method, parameters=None, response_parser=None):
         """send request to radosgw"""
         return make_request(self.conn, method, self.resource,
-                            parameters=parameters, sign_parameters=True)
+                            parameters=parameters, sign_parameters=True,
+                            response_parser=response_parser)
 
     def get_config(self, notification=None):
         """get notification info"""
@@ -186,9 +351,10 @@ class PSNotificationS3:
             status = response['ResponseMetadata']['HTTPStatusCode']
             return response, status
         parameters = {'notification': notification}
-        response, status = self.send_request('GET', parameters=parameters)
-        dict_response = xmltodict.parse(response)
-        return dict_response, status
+        # parse the XML directly from the http response as it is received
+        # plain dicts are cheaper to build than the default OrderedDict, and order is not needed
+        return self.send_request('GET', parameters=parameters,
+                                 response_parser=lambda response: xmltodict.parse(response, dict_constructor=dict))
 
     def set_config(self):
         """set notification"""
@@ -217,7 +383,7 @@ class PSSubscription:
     """
     def __init__(self, conn, sub_name, topic_name, endpoint=None, endpoint_args=None):
         self.conn = conn
-        assert topic_name.strip()
+        _require_nonblank('topic_name', topic_name)
         self.resource = '/subscriptions/'+sub_name
         if endpoint is not None:
             self.parameters = {'topic': topic_name, 'push-endpoint': endpoint}
@@ -225,12 +391,14 @@ class PSSubscription:
         else:
             self.parameters = {'topic': topic_name}
             self.extra_parameters = None
+        self.url_params = build_url_params(self.parameters, self.extra_parameters)
 
-    def send_request(self, method, parameters=None, extra_parameters=None):
+    def send_request(self, method, parameters=None, extra_parameters=None, precomputed_url_params=None):
         """send request to radosgw"""
         return make_request(self.conn, method, self.resource, 
                             parameters=parameters,
-                            extra_parameters=extra_parameters)
+                            extra_parameters=extra_parameters,
+                            precomputed_url_params=precomputed_url_params)
 
     def get_config(self):
         """get subscription info"""
@@ -238,7 +406,7 @@ class PSSubscription:
 
     def set_config(self):
         """set subscription"""
-        return self.send_request('PUT', parameters=self.parameters, extra_parameters=self.extra_parameters)
+        return self.send_request('PUT', precomputed_url_params=self.url_params)
 
     def del_config(self, topic=False):
         """delete subscription"""
@@ -259,3 +427,26 @@ class PSSubscription:
         """ ack events in a subscription """
         parameters = {'ack': None, 'event-id': event_id}
         return self.send_request('POST', parameters)
+
+    def drain_events(self, page_size=1000, auto_ack=False):
+        """ get all events from subscription, page by page, and optionally ack them
+        returns the list of events and the status of the last request
+        """
+        all_events = []
+        marker = None
+        while True:
+            result, status = self.get_events(page_size, marker)
+            if status/100 != 2:
+                return all_events, status
+            parsed_result = json.loads(result)
+            all_events.extend(parsed_result['events'])
+            marker = parsed_result['next_marker']
+            if marker == '':
+                break
+        if auto_ack:
+            # radosgw acks a single event per request
+            for event in all_events:
+                _, status = self.ack_events(event['id'])
+                if status/100 != 2:
+                    break
+        return all_events, status
@@ -19,6 +19,7 @@ from rgw_multi.zone_es import ESZoneConfig as ESZoneConfig
 from rgw_multi.zone_cloud import CloudZone as CloudZone
 from rgw_multi.zone_cloud import CloudZoneConfig as CloudZoneConfig
 from rgw_multi.zone_ps import PSZone as PSZone
+from rgw_multi.zone_ps import set_debug as set_ps_debug
 
 # make tests from rgw_multi.tests available to nose
 from rgw_multi.tests import *
@@ -158,6 +159,7 @@ def setup_logging(log_level_console, log_file, log_level_file):
     ch.setLevel(get_log_level(log_level_console))
     log.addHandler(ch)
     log.setLevel(get_log_level(log_level_console))
+    set_ps_debug(log.getEffectiveLevel() <= logging.DEBUG)
 
 def init(parse_args):
     cfg = configparser.RawConfigParser({